@@ -1,12 +1,22 @@
 import streamlit as st
-import requests
-import json
+import httpx
+import atexit
+import asyncio
+import concurrent.futures
+import hashlib
 import datetime
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import smtplib
+import contextlib
 import os
-from openai import OpenAI
+import threading
+import cachetools
+import numpy as np
+import nh3
+from pydantic import BaseModel, Field, create_model
+from jinja2 import Environment, select_autoescape
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient
 
 # Fetch secrets
 GMAIL_PASSWORD = st.secrets["GMAIL_PASSWORD"]
@@ -16,21 +26,105 @@ OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
 # Ensure the API key is loaded
 if not OPENAI_API_KEY:
     st.error("OpenAI API key is not set in the environment variables.")
-else:
-    client = OpenAI(api_key=OPENAI_API_KEY)
+
+# Semantic cache settings
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_MAX_CHARS = 24000  # Per chunk; stays well under the embedding model's 8191 token input limit
+EMBEDDING_BATCH_SIZE = 32  # Chunks per embeddings request
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_MAX_LENGTH_DRIFT = 0.05  # A semantic hit must be within 5% of the cached transcript's length
+SEMANTIC_CACHE_MAX_ENTRIES = 50
+ANALYSIS_CACHE_TTL = 3600  # Seconds
+ANALYSIS_CACHE_MAX_ENTRIES = 200
+
+# Seconds between checks for new streamed content to render
+STREAM_RENDER_INTERVAL = 0.25
+
+PROMPTS = {
+    'financial': "Analyze this meeting transcript and provide a JSON summary focusing on financial discussions, key figures, and monetary decisions. Include any mentioned budgets, costs, revenues, or financial projections.",
+    'action_items': "Analyze this meeting transcript and provide a JSON summary of all action items, tasks, and deadlines discussed. Include who is responsible for each item and any mentioned due dates.",
+    'risk_assessment': "Analyze this meeting transcript and provide a JSON summary of any discussed risks, potential issues, or areas of concern. Include any mitigation strategies or risk assessments mentioned.",
+    'tax_info': "Analyze this meeting transcript and provide a JSON summary of all tax-related information discussed. Include any mentions of tax planning, changes in tax laws, or specific tax concerns of the client.",
+    'client_concerns': "Analyze this meeting transcript and provide a JSON summary of all client questions, concerns, or areas where the client expressed confusion or needed clarification.",
+    'compliance': "Analyze this meeting transcript and provide a JSON summary of all compliance and regulatory matters discussed. Include any mentions of legal requirements, industry standards, or regulatory changes."
+}
+
+SYSTEM_PROMPT_ANALYSIS = "You are an AI assistant specialized in analyzing meeting transcripts for accounting professionals. You must only reply with JSON. [no prose]"
+
+ANALYSIS_INSTRUCTIONS = "Analyze this meeting transcript once for each of the following analysis types:\n\n" + '\n'.join(
+    f'- "{prompt_type}": {prompt}' for prompt_type, prompt in PROMPTS.items()
+) + "\n\nReturn one analysis per analysis type."
+
+SYSTEM_PROMPT_EMAIL = "You are an AI assistant helping an accountant draft a follow-up email after a client meeting. The email should sound authentic, professional, and as if it's coming directly from the accountant who organized the meeting. You must only reply with JSON containing the email content."
+
+EMAIL_INSTRUCTIONS = """Based on the following meeting transcript, create a follow-up email to the client. The email should:
+
+1. Briefly summarize the key points discussed in the meeting
+2. Confirm any responsibilities or action items for the client
+3. Mention any deadlines discussed or set reasonable deadlines if none were specified
+4. Sound authentic and professional, as if written by the accountant who organized the meeting
+5. End with a polite closing and offer for further assistance
+
+Format the email with appropriate HTML tags, including <p> for paragraphs, <br> for line breaks, and any other relevant HTML formatting."""
+
+# Selectbox option that runs every analysis and emails them together
+ALL_ANALYSES = 'all'
+
+ANALYSIS_LABELS = {
+    'financial': 'Financial Analysis',
+    'action_items': 'Action Items',
+    'risk_assessment': 'Risk Assessment',
+    'tax_info': 'Tax Information',
+    'client_concerns': 'Client Concerns',
+    'compliance': 'Compliance Matters',
+    ALL_ANALYSES: 'All Analyses'
+}
+
+FIREFLIES_API_URL = 'https://api.fireflies.ai/graphql'
+
+# Only this much of the transcript is sent to the browser on each rerun
+TRANSCRIPT_PREVIEW_CHARS = 5000
+
+@st.cache_resource
+def fireflies_client():
+    # Shared across reruns so refreshes reuse a pooled HTTP/2 connection
+    http_client = httpx.Client(
+        http2=True,
+        timeout=30.0,
+        headers={
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip'
+        }
+    )
+    atexit.register(http_client.close)
+    return http_client
+
+def fireflies_query(api_key, query, variables):
+    headers = {'Authorization': f'Bearer {api_key}'}
+    response = fireflies_client().post(FIREFLIES_API_URL, json={'query': query, 'variables': variables}, headers=headers)
+    if response.status_code != 200:
+        raise Exception(f"API request failed with status code {response.status_code}")
+    return response.json()['data']
 
 def fetch_transcripts(api_key):
-    url = 'https://api.fireflies.ai/graphql'
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {api_key}'
-    }
+    # Only the fields needed for the transcript picker; sentences are fetched on selection
     query = """
     query Transcripts($limit: Int) {
         transcripts(limit: $limit) {
             id
             title
             date
+        }
+    }
+    """
+    variables = {"limit": 10}
+    return fireflies_query(api_key, query, variables)['transcripts']
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_transcript_sentences(api_key, transcript_id):
+    query = """
+    query Transcript($transcriptId: String!) {
+        transcript(id: $transcriptId) {
             sentences {
                 text
                 speaker_name
@@ -38,220 +132,210 @@ def fetch_transcripts(api_key):
         }
     }
     """
-    variables = {"limit": 10}
-    response = requests.post(url, json={'query': query, 'variables': variables}, headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"API request failed with status code {response.status_code}")
-    return response.json()['data']['transcripts']
-
-def get_transcript_content(transcript):
-    return '\n'.join([f"{sentence['speaker_name']}: {sentence['text']}" for sentence in transcript['sentences']])
-
-def gpt4o_json_prompt(transcript_content, prompt_type):
-    prompts = {
-        'financial': "Analyze this meeting transcript and provide a JSON summary focusing on financial discussions, key figures, and monetary decisions. Include any mentioned budgets, costs, revenues, or financial projections.",
-        'action_items': "Analyze this meeting transcript and provide a JSON summary of all action items, tasks, and deadlines discussed. Include who is responsible for each item and any mentioned due dates.",
-        'risk_assessment': "Analyze this meeting transcript and provide a JSON summary of any discussed risks, potential issues, or areas of concern. Include any mitigation strategies or risk assessments mentioned.",
-        'tax_info': "Analyze this meeting transcript and provide a JSON summary of all tax-related information discussed. Include any mentions of tax planning, changes in tax laws, or specific tax concerns of the client.",
-        'client_concerns': "Analyze this meeting transcript and provide a JSON summary of all client questions, concerns, or areas where the client expressed confusion or needed clarification.",
-        'compliance': "Analyze this meeting transcript and provide a JSON summary of all compliance and regulatory matters discussed. Include any mentions of legal requirements, industry standards, or regulatory changes."
-    }
-
-    try:
-        with st.spinner('Analyzing transcript...'):
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are an AI assistant specialized in analyzing meeting transcripts for accounting professionals. You must only reply with JSON. [no prose]"},
-                    {"role": "user", "content": f"""{prompts[prompt_type]}
-
-                    Provide the summary in the following JSON structure:
-                    {{
-                        "summary": "A concise summary of the requested information",
-                        "key_points": ["point1", "point2", "point3"],
-                        "details": [
-                            {{
-                                "topic": "Specific topic or item",
-                                "description": "Detailed description",
-                                "relevance": "Why this is important for the accountant"
-                            }},
-                            ...
-                        ],
-                        "follow_up_suggestions": ["suggestion1", "suggestion2"]
-                    }}
-
-                    Transcript:
-                    {transcript_content}
-
-                    [Output only JSON]"""}
-                ],
-                temperature=0.7,
-                max_tokens=3000,
-                response_format={"type": "json_object"},
-                logit_bias={123: 100}  # Increase likelihood of `{` to start the response
-            )
-        
-        # Check if the response content is valid JSON
-        try:
-            return json.loads(response.choices[0].message.content)
-        except json.JSONDecodeError as json_error:
-            st.error(f"Error decoding JSON: {json_error}")
-            st.error(f"Raw response: {response.choices[0].message.content}")
-            return None
-    except Exception as e:
-        st.error(f"An error occurred while analyzing the transcript: {e}")
-        return None
+    variables = {"transcriptId": transcript_id}
+    return fireflies_query(api_key, query, variables)['transcript']['sentences'] or []
+
+def summarize_transcript(sentences):
+    # Build the transcript text and the speaker set in a single pass over the sentences
+    lines = []
+    speakers = set()
+    for sentence in sentences:
+        lines.append(f"{sentence['speaker_name']}: {sentence['text']}")
+        speakers.add(sentence['speaker_name'])
+    return '\n'.join(lines), speakers
+
+def get_prepped_transcript(api_key, transcript_id):
+    key = f"prepped_{transcript_id}"
+    if key not in st.session_state:
+        st.session_state[key] = summarize_transcript(fetch_transcript_sentences(api_key, transcript_id))
+    return st.session_state[key]
+
+class Detail(BaseModel):
+    topic: str = Field(description="Specific topic or item")
+    description: str = Field(description="Detailed description")
+    relevance: str = Field(description="Why this is important for the accountant")
+
+class Analysis(BaseModel):
+    summary: str = Field(description="A concise summary of the requested information")
+    key_points: list[str]
+    details: list[Detail]
+    follow_up_suggestions: list[str]
+
+# One Analysis per entry in PROMPTS
+AllAnalyses = create_model('AllAnalyses', **{prompt_type: (Analysis, ...) for prompt_type in PROMPTS})
+
+class FollowUpEmail(BaseModel):
+    subject: str = Field(description="Meeting Follow-up: [Brief Description]")
+    body: str = Field(description="HTML formatted email content")
+
+@st.cache_resource
+def openai_client():
+    # Synchronous client for embeddings, kept across reruns
+    return OpenAI(api_key=OPENAI_API_KEY)
+
+@st.cache_resource
+def openai_event_loop():
+    # Async clients are bound to the event loop that uses them, so completions
+    # run on one long-lived loop in a daemon thread. That lets a single
+    # AsyncOpenAI client and its HTTP/2 connection pool serve every rerun.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='openai-event-loop', daemon=True).start()
+    return loop
+
+@st.cache_resource
+def async_openai_client():
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=DefaultAsyncHttpxClient(http2=True))
+
+async def stream_structured_completion(aclient, response_format, partials=None, partial_key=None, **kwargs):
+    # Structured outputs guarantee the response matches response_format, and the
+    # stream yields partially parsed snapshots. The latest one is stored in
+    # partials[partial_key] for the script thread to render.
+    async with aclient.beta.chat.completions.stream(response_format=response_format, **kwargs) as stream:
+        async for event in stream:
+            if partials is not None and event.type == 'content.delta' and event.parsed is not None:
+                partials[partial_key] = event.parsed
+        completion = await stream.get_final_completion()
+
+    message = completion.choices[0].message
+    if message.refusal:
+        raise Exception(f"The model refused the request: {message.refusal}")
+    return message.parsed.model_dump()
+
+async def gpt4o_all_analyses(aclient, transcript_content, partials=None):
+    return await stream_structured_completion(
+        aclient,
+        AllAnalyses,
+        partials,
+        'analysis',
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT_ANALYSIS},
+            {"role": "user", "content": f"{ANALYSIS_INSTRUCTIONS}\n\nTranscript:\n{transcript_content}"}
+        ],
+        temperature=0.7,
+        max_tokens=12000
+    )
 
-def generate_follow_up_email(transcript_content):
-    try:
-        with st.spinner('Generating follow-up email...'):
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are an AI assistant helping an accountant draft a follow-up email after a client meeting. The email should sound authentic, professional, and as if it's coming directly from the accountant who organized the meeting. You must only reply with JSON containing the email content."},
-                    {"role": "user", "content": f"""Based on the following meeting transcript, create a follow-up email to the client. The email should:
-
-                    1. Briefly summarize the key points discussed in the meeting
-                    2. Confirm any responsibilities or action items for the client
-                    3. Mention any deadlines discussed or set reasonable deadlines if none were specified
-                    4. Sound authentic and professional, as if written by the accountant who organized the meeting
-                    5. End with a polite closing and offer for further assistance
-
-                    Format the email with appropriate HTML tags, including <p> for paragraphs, <br> for line breaks, and any other relevant HTML formatting.
-
-                    Provide the email content in the following JSON structure:
-                    {{
-                        "subject": "Meeting Follow-up: [Brief Description]",
-                        "body": "HTML formatted email content"
-                    }}
-
-                    Transcript:
-                    {transcript_content}
-
-                    [Output only JSON]"""}
-                ],
-                temperature=0.7,
-                max_tokens=2000,
-                response_format={"type": "json_object"},
-                logit_bias={123: 100}  # Increase likelihood of `{` to start the response
-            )
-        
-        # Check if the response content is valid JSON
-        try:
-            return json.loads(response.choices[0].message.content)
-        except json.JSONDecodeError as json_error:
-            st.error(f"Error decoding JSON for follow-up email: {json_error}")
-            st.error(f"Raw response: {response.choices[0].message.content}")
-            return None
-    except Exception as e:
-        st.error(f"An error occurred while generating the follow-up email: {e}")
-        return None
+async def generate_follow_up_email(aclient, transcript_content, partials=None):
+    return await stream_structured_completion(
+        aclient,
+        FollowUpEmail,
+        partials,
+        'email',
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT_EMAIL},
+            {"role": "user", "content": f"{EMAIL_INSTRUCTIONS}\n\nTranscript:\n{transcript_content}"}
+        ],
+        temperature=0.7,
+        max_tokens=2000
+    )
 
-def format_analysis_to_html(analysis_type, gpt4o_response, follow_up_email):
-    html_content = f"""
-    <html>
-    <head>
-        <style>
-            body {{
+EMAIL_CSS = """
+            body {
                 font-family: Arial, sans-serif;
                 line-height: 1.6;
                 color: #333;
                 max-width: 800px;
                 margin: 0 auto;
                 padding: 20px;
-            }}
-            .header {{
+            }
+            .header {
                 background-color: #007bff;
                 color: white;
                 padding: 20px;
                 text-align: center;
-            }}
-            h1, h2 {{
+            }
+            h1, h2 {
                 margin: 0;
-            }}
-            h2 {{
+            }
+            h2 {
                 color: #007bff;
                 border-bottom: 2px solid #007bff;
                 padding-bottom: 10px;
-            }}
-            .section {{
+            }
+            .section {
                 margin-bottom: 30px;
-            }}
-            ul {{
+            }
+            ul {
                 padding-left: 20px;
-            }}
-            .detail {{
+            }
+            .detail {
                 background-color: #f8f9fa;
                 border-left: 4px solid #007bff;
                 padding: 15px;
                 margin-bottom: 20px;
-            }}
-            .footer {{
+            }
+            .footer {
                 text-align: center;
                 margin-top: 40px;
                 font-size: 0.9em;
                 color: #666;
-            }}
-            .follow-up {{
+            }
+            .analysis-title {
+                color: #007bff;
+                margin-top: 40px;
+            }
+            .follow-up {
                 margin-top: 40px;
                 border-top: 2px solid #007bff;
                 padding-top: 20px;
-            }}
-        </style>
+            }
+"""
+
+ANALYSIS_HTML_TEMPLATE = """
+    <html>
+    <head>
+        <style>""" + EMAIL_CSS + """</style>
     </head>
     <body>
         <div class="header">
-            <h1>{analysis_type.replace('_', ' ').title()} Analysis</h1>
+            <h1>{{ title }}</h1>
         </div>
+        {% for analysis_title, response in analyses %}
+        {% if analyses|length > 1 %}
+        <h1 class="analysis-title">{{ analysis_title }}</h1>
+        {% endif %}
 
         <div class="section">
             <h2>Summary</h2>
-            <p>{gpt4o_response['summary']}</p>
+            <p>{{ response.summary }}</p>
         </div>
 
         <div class="section">
             <h2>Key Points</h2>
             <ul>
-    """
-
-    for point in gpt4o_response['key_points']:
-        html_content += f"<li>{point}</li>"
-
-    html_content += """
+            {% for point in response.key_points %}
+                <li>{{ point }}</li>
+            {% endfor %}
             </ul>
         </div>
 
         <div class="section">
             <h2>Details</h2>
-    """
-
-    for detail in gpt4o_response['details']:
-        html_content += f"""
+            {% for detail in response.details %}
             <div class="detail">
-                <h3>{detail['topic']}</h3>
-                <p><strong>Description:</strong> {detail['description']}</p>
-                <p><strong>Relevance:</strong> {detail['relevance']}</p>
+                <h3>{{ detail.topic }}</h3>
+                <p><strong>Description:</strong> {{ detail.description }}</p>
+                <p><strong>Relevance:</strong> {{ detail.relevance }}</p>
             </div>
-        """
-
-    html_content += """
+            {% endfor %}
         </div>
 
         <div class="section">
             <h2>Follow-up Suggestions</h2>
             <ul>
-    """
-
-    for suggestion in gpt4o_response['follow_up_suggestions']:
-        html_content += f"<li>{suggestion}</li>"
-
-    html_content += f"""
+            {% for suggestion in response.follow_up_suggestions %}
+                <li>{{ suggestion }}</li>
+            {% endfor %}
             </ul>
         </div>
+        {% endfor %}
 
         <div class="follow-up">
             <h2>Follow-up Email</h2>
-            {follow_up_email}
+            {# The follow-up email body is HTML by design; it is sanitized before rendering #}
+            {{ follow_up_email|safe }}
         </div>
 
         <div class="footer">
@@ -260,7 +344,35 @@ def format_analysis_to_html(analysis_type, gpt4o_response, follow_up_email):
     </body>
     </html>
     """
-    return html_content
+
+# Compiled once; autoescaping keeps model output from injecting markup into the email
+ANALYSIS_HTML = Environment(autoescape=select_autoescape()).from_string(ANALYSIS_HTML_TEMPLATE)
+
+# Formatting tags the follow-up email prompt asks for. Everything else, and
+# every attribute, is stripped, since the body is written from a transcript
+# that meeting participants control.
+EMAIL_BODY_TAGS = {'p', 'br', 'strong', 'b', 'em', 'i', 'u', 'ul', 'ol', 'li', 'h3', 'h4'}
+
+def sanitize_email_body(body):
+    return nh3.clean(body, tags=EMAIL_BODY_TAGS, attributes={})
+
+def format_analysis_to_html(analysis_type, gpt4o_responses, follow_up_email):
+    if analysis_type == ALL_ANALYSES:
+        title = ANALYSIS_LABELS[ALL_ANALYSES]
+    else:
+        title = f"{analysis_type.replace('_', ' ').title()} Analysis"
+    analyses = [
+        (f"{response_type.replace('_', ' ').title()} Analysis", gpt4o_response)
+        for response_type, gpt4o_response in gpt4o_responses.items()
+    ]
+    return ANALYSIS_HTML.render(title=title, analyses=analyses, follow_up_email=sanitize_email_body(follow_up_email))
+
+@contextlib.contextmanager
+def smtp_session():
+    # One TLS handshake and login, reusable for several messages
+    with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp_server:
+        smtp_server.login(GMAIL_USER, GMAIL_PASSWORD)
+        yield smtp_server
 
 def send_email(recipient_email, subject, html_content):
     try:
@@ -272,13 +384,213 @@ def send_email(recipient_email, subject, html_content):
         html_part = MIMEText(html_content, 'html')
         msg.attach(html_part)
 
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp_server:
-            smtp_server.login(GMAIL_USER, GMAIL_PASSWORD)
+        with smtp_session() as smtp_server:
             smtp_server.sendmail(GMAIL_USER, recipient_email, msg.as_string())
         st.success("Email sent successfully!")
     except Exception as e:
         st.error(f"Error sending email: {e}")
 
+async def run_analysis(aclient, transcript_content, partials=None):
+    # Runs on the OpenAI event loop thread, where st.* is unavailable, so
+    # failures are returned in place of the result instead of being displayed.
+    # Both requests only depend on the transcript, so issue them concurrently.
+    return await asyncio.gather(
+        gpt4o_all_analyses(aclient, transcript_content, partials),
+        generate_follow_up_email(aclient, transcript_content, partials),
+        return_exceptions=True
+    )
+
+def submit_analysis(transcript_content, partials=None):
+    # Returns a concurrent.futures.Future for (analyses, follow_up_email). The
+    # result is cached from the loop thread as soon as it lands, so it isn't
+    # lost when the rerun that was following it gets interrupted.
+    content_hash = hash_transcript(transcript_content)
+    future = asyncio.run_coroutine_threadsafe(
+        run_analysis(async_openai_client(), transcript_content, partials),
+        openai_event_loop()
+    )
+
+    def cache_result(done):
+        if done.cancelled() or done.exception() is not None:
+            return
+        if analysis_succeeded(done.result()):
+            store_cached_analysis(content_hash, done.result())
+
+    future.add_done_callback(cache_result)
+    return future
+
+def follow_analysis(future, partials, on_analysis_update=None, on_email_update=None):
+    # Renders the latest streamed snapshots on the script thread until the run finishes
+    callbacks = {'analysis': on_analysis_update, 'email': on_email_update}
+    rendered = {}
+    while True:
+        done, _ = concurrent.futures.wait([future], timeout=STREAM_RENDER_INTERVAL)
+        for key, callback in callbacks.items():
+            partial = partials.get(key)
+            if callback and partial is not None and partial is not rendered.get(key):
+                rendered[key] = partial
+                callback(partial)
+        if done:
+            return future.result()
+
+def analysis_succeeded(result):
+    return not any(isinstance(item, BaseException) for item in result)
+
+def report_analysis_errors(result):
+    analyses, follow_up_email = result
+    if isinstance(analyses, BaseException):
+        st.error(f"An error occurred while analyzing the transcript: {analyses}")
+    if isinstance(follow_up_email, BaseException):
+        st.error(f"An error occurred while generating the follow-up email: {follow_up_email}")
+
+def hash_transcript(transcript_content):
+    return hashlib.sha256(transcript_content.encode('utf-8')).hexdigest()
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def embed_transcript(content_hash, _transcript_content):
+    # Embed the whole transcript in chunks and mean-pool them, so transcripts
+    # that only share their opening don't end up with the same embedding
+    chunks = [
+        _transcript_content[start:start + EMBEDDING_MAX_CHARS]
+        for start in range(0, len(_transcript_content), EMBEDDING_MAX_CHARS)
+    ]
+    if not chunks:
+        return None
+    chunk_embeddings = []
+    for start in range(0, len(chunks), EMBEDDING_BATCH_SIZE):
+        response = openai_client().embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=chunks[start:start + EMBEDDING_BATCH_SIZE]
+        )
+        chunk_embeddings.extend(item.embedding for item in response.data)
+    chunk_embeddings = np.array(chunk_embeddings)
+    chunk_embeddings /= np.linalg.norm(chunk_embeddings, axis=1, keepdims=True)
+    embedding = chunk_embeddings.mean(axis=0)
+    return embedding / np.linalg.norm(embedding)
+
+@st.cache_resource
+def analysis_cache():
+    # Exact-match results shared across sessions. This can't be st.cache_data
+    # because streaming writes into placeholders owned by the caller, which
+    # cached functions are not allowed to replay. TTLCache isn't thread-safe,
+    # so every access goes through the lock.
+    return cachetools.TTLCache(maxsize=ANALYSIS_CACHE_MAX_ENTRIES, ttl=ANALYSIS_CACHE_TTL), threading.Lock()
+
+def lookup_cached_analysis(content_hash):
+    cache, lock = analysis_cache()
+    with lock:
+        return cache.get(content_hash)
+
+def store_cached_analysis(content_hash, result):
+    cache, lock = analysis_cache()
+    with lock:
+        cache[content_hash] = result
+
+def semantic_cache_lookup(embedding, length):
+    # Only transcripts of about the same length are candidates, so a transcript
+    # re-fetched after more of it was processed doesn't reuse the shorter analysis
+    entries = [
+        entry for entry in st.session_state.semantic_cache.values()
+        if abs(entry['length'] - length) <= SEMANTIC_CACHE_MAX_LENGTH_DRIFT * max(entry['length'], length)
+    ]
+    if not entries:
+        return None
+    # Embeddings are normalized, so the dot product is the cosine similarity
+    similarities = np.array([entry['embedding'] for entry in entries]) @ embedding
+    best = int(np.argmax(similarities))
+    if similarities[best] >= SEMANTIC_CACHE_THRESHOLD:
+        return entries[best]['result']
+    return None
+
+def prune_pending_analyses():
+    # A finished run has either failed or already been stored in the shared
+    # cache, so its entry is only holding memory and blocking a retry
+    pending = st.session_state.pending_analyses
+    for content_hash in [h for h, (future, _) in pending.items() if future.done()]:
+        del pending[content_hash]
+
+def start_analysis(transcript_content):
+    # Runs are tracked per session by content hash, so a click interrupted by a
+    # rerun picks its run up again instead of paying for a duplicate
+    partials = {}
+    future = submit_analysis(transcript_content, partials)
+    st.session_state.pending_analyses[hash_transcript(transcript_content)] = (future, partials)
+
+def start_prefetch(transcript_content):
+    # Speculatively analyze a transcript in the background so the result is
+    # ready by the time the user asks for it
+    prune_pending_analyses()
+    content_hash = hash_transcript(transcript_content)
+    if content_hash in st.session_state.analyses or content_hash in st.session_state.pending_analyses:
+        return
+    if lookup_cached_analysis(content_hash):
+        return
+    start_analysis(transcript_content)
+
+def follow_pending_analysis(content_hash, on_analysis_update=None, on_email_update=None):
+    # A run that is still going is ahead of a fresh request, so follow it to
+    # completion rather than starting a duplicate. The entry is only dropped
+    # once the run has finished and its result has been used.
+    pending = st.session_state.pending_analyses.get(content_hash)
+    if pending is None:
+        return None
+    future, partials = pending
+    try:
+        result = follow_analysis(future, partials, on_analysis_update, on_email_update)
+    except Exception as e:
+        result = (e, e)
+    st.session_state.pending_analyses.pop(content_hash, None)
+    return result
+
+def store_semantic_entry(content_hash, embedding, length, result):
+    semantic_cache = st.session_state.semantic_cache
+    # Keyed by content hash, so a transcript is stored once; the oldest entries go first
+    semantic_cache.pop(content_hash, None)
+    semantic_cache[content_hash] = {
+        'embedding': embedding,
+        'length': length,
+        'result': result
+    }
+    while len(semantic_cache) > SEMANTIC_CACHE_MAX_ENTRIES:
+        del semantic_cache[next(iter(semantic_cache))]
+
+def get_analyses(transcript_content, on_analysis_update=None, on_email_update=None):
+    content_hash = hash_transcript(transcript_content)
+
+    cached = lookup_cached_analysis(content_hash)
+    if cached:
+        return cached
+
+    # A pending run analyzed this exact transcript, so it beats an approximate
+    # semantic match; a failed one falls through to a fresh request
+    result = follow_pending_analysis(content_hash, on_analysis_update, on_email_update)
+    if result is not None and not analysis_succeeded(result):
+        errors = '; '.join(dict.fromkeys(str(item) for item in result if isinstance(item, BaseException)))
+        st.warning(f"Background analysis failed, retrying: {errors}")
+        result = None
+
+    try:
+        embedding = embed_transcript(content_hash, transcript_content)
+    except Exception as e:
+        st.warning(f"Semantic cache unavailable, falling back to exact matching: {e}")
+        embedding = None
+
+    if result is None:
+        if embedding is not None:
+            cached = semantic_cache_lookup(embedding, len(transcript_content))
+            if cached:
+                return cached
+        start_analysis(transcript_content)
+        result = follow_pending_analysis(content_hash, on_analysis_update, on_email_update)
+    if not analysis_succeeded(result):
+        report_analysis_errors(result)
+        return None, None
+    store_cached_analysis(content_hash, result)
+
+    if embedding is not None:
+        store_semantic_entry(content_hash, embedding, len(transcript_content), result)
+    return result
+
 # Streamlit UI
 st.title('Fireflies Meeting Prototype')
 
@@ -294,103 +606,157 @@ refresh_button = st.button('Refresh Transcripts')
 # Use session state to store transcripts and selected transcript ID
 if 'transcripts' not in st.session_state:
     st.session_state.transcripts = []
+    st.session_state.transcripts_by_id = {}
 if 'selected_transcript_id' not in st.session_state:
     st.session_state.selected_transcript_id = None
+if 'semantic_cache' not in st.session_state:
+    st.session_state.semantic_cache = {}
+if 'analyses' not in st.session_state:
+    st.session_state.analyses = {}
+if 'pending_analyses' not in st.session_state:
+    st.session_state.pending_analyses = {}
 
 if fireflies_api_key and refresh_button:
     with st.spinner('Refreshing transcripts...'):
         try:
             st.session_state.transcripts = fetch_transcripts(fireflies_api_key)
+            st.session_state.transcripts_by_id = {t['id']: t for t in st.session_state.transcripts}
+            # Drop cached sentences as well, so a refresh picks up updated transcripts
+            fetch_transcript_sentences.clear()
+            for key in [key for key in st.session_state if key.startswith('prepped_')]:
+                del st.session_state[key]
             st.success("Transcripts refreshed successfully.")
+
+            # Start analyzing the most recent transcript while the user decides what to look at
+            if st.session_state.transcripts:
+                latest_id = st.session_state.transcripts[0]['id']
+                try:
+                    latest_content, _ = get_prepped_transcript(fireflies_api_key, latest_id)
+                    start_prefetch(latest_content)
+                except Exception:
+                    pass  # The prefetch is best-effort; a real click fetches and analyzes normally
         except Exception as e:
             st.error(f"Error refreshing transcripts: {e}")
 
 if st.session_state.transcripts:
-    transcript_options = [t['id'] for t in st.session_state.transcripts]
-    transcript_titles = [t['title'] for t in st.session_state.transcripts]
+    transcripts_by_id = st.session_state.transcripts_by_id
 
     transcript_id = st.selectbox(
         'Select Transcript',
-        options=transcript_options,
-        format_func=lambda x: transcript_titles[transcript_options.index(x)] if x in transcript_options else ""
+        options=list(transcripts_by_id),
+        format_func=lambda x: transcripts_by_id[x]['title'] if x in transcripts_by_id else ""
     )
 
     if transcript_id:
         st.session_state.selected_transcript_id = transcript_id
 
 if st.session_state.selected_transcript_id:
-    selected_transcript = next(
-        t for t in st.session_state.transcripts if t['id'] == st.session_state.selected_transcript_id
-    )
-    transcript_content = get_transcript_content(selected_transcript)
-    st.text_area('Transcript', transcript_content, height=200, disabled=True)
-
-analyze_buttons = {
-    'financial': st.button('Financial Analysis'),
-    'action_items': st.button('Action Items'),
-    'risk_assessment': st.button('Risk Assessment'),
-    'tax_info': st.button('Tax Information'),
-    'client_concerns': st.button('Client Concerns'),
-    'compliance': st.button('Compliance Matters')
-}
+    with st.spinner('Loading transcript...'):
+        try:
+            transcript_content, _ = get_prepped_transcript(fireflies_api_key, st.session_state.selected_transcript_id)
+            with st.expander('Show transcript'):
+                preview = transcript_content[:TRANSCRIPT_PREVIEW_CHARS]
+                if len(transcript_content) > TRANSCRIPT_PREVIEW_CHARS:
+                    preview += '...'
+                st.text_area('Transcript', preview, height=200, disabled=True)
+        except Exception as e:
+            st.error(f"Error loading transcript: {e}")
+
+analysis_type = st.selectbox('Analysis Type', options=[*PROMPTS, ALL_ANALYSES], format_func=ANALYSIS_LABELS.get)
+analyze_button = st.button('Analyze')
+
+def render_analysis(prompt_type, gpt4o_response):
+    # Keys may be missing while the response is still streaming
+    st.write(f"## {prompt_type.replace('_', ' ').title()} Analysis")
+    if gpt4o_response.get('summary'):
+        st.write(f"### Summary\n{gpt4o_response['summary']}")
+    if gpt4o_response.get('key_points'):
+        st.write("### Key Points")
+        for point in gpt4o_response['key_points']:
+            st.write(f"- {point}")
+    if gpt4o_response.get('details'):
+        st.write("### Details")
+        for detail in gpt4o_response['details']:
+            st.write(f"#### {detail.get('topic') or ''}")
+            st.write(f"Description: {detail.get('description') or ''}")
+            st.write(f"Relevance: {detail.get('relevance') or ''}")
+            st.write("")
+    if gpt4o_response.get('follow_up_suggestions'):
+        st.write("### Follow-up Suggestions")
+        for suggestion in gpt4o_response['follow_up_suggestions']:
+            st.write(f"- {suggestion}")
+
+def render_follow_up_email(follow_up_email):
+    st.write("### Follow-up Email")
+    st.markdown(sanitize_email_body(follow_up_email.get('body', '')), unsafe_allow_html=True)
 
 def handle_analysis(prompt_type):
-    if st.session_state.selected_transcript_id:
-        selected_transcript = next(
-            t for t in st.session_state.transcripts if t['id'] == st.session_state.selected_transcript_id
-        )
-        transcript_content = get_transcript_content(selected_transcript)
-        st.write(f"Analyzing with GPT-4o: {prompt_type.replace('_', ' ').title()}...")
-        gpt4o_response = gpt4o_json_prompt(transcript_content, prompt_type)
-        follow_up_email = generate_follow_up_email(transcript_content)
-        if gpt4o_response and follow_up_email:
-            st.write(f"## {prompt_type.replace('_', ' ').title()} Analysis")
-            st.write(f"### Summary\n{gpt4o_response['summary']}")
-            st.write("### Key Points")
-            for point in gpt4o_response['key_points']:
-                st.write(f"- {point}")
-            st.write("### Details")
-            for detail in gpt4o_response['details']:
-                st.write(f"#### {detail['topic']}")
-                st.write(f"Description: {detail['description']}")
-                st.write(f"Relevance: {detail['relevance']}")
-                st.write("")
-            st.write("### Follow-up Suggestions")
-            for suggestion in gpt4o_response['follow_up_suggestions']:
-                st.write(f"- {suggestion}")
-            st.write("### Follow-up Email")
-            st.markdown(follow_up_email['body'], unsafe_allow_html=True)
+    transcript_id = st.session_state.selected_transcript_id
+    # Populated when the selected transcript was loaded above
+    prepped = st.session_state.get(f"prepped_{transcript_id}")
+    if prepped:
+        selected_transcript = st.session_state.transcripts_by_id[transcript_id]
+        transcript_content, speakers = prepped
+        prompt_types = list(PROMPTS) if prompt_type == ALL_ANALYSES else [prompt_type]
+        st.write(f"Analyzing with GPT-4o: {ANALYSIS_LABELS[prompt_type]}...")
+        analysis_placeholder = st.empty()
+        email_placeholder = st.empty()
+
+        def show_partial_analysis(partial):
+            if not isinstance(partial, dict):
+                return
+            partial_responses = {t: partial[t] for t in prompt_types if isinstance(partial.get(t), dict)}
+            if partial_responses:
+                with analysis_placeholder.container():
+                    for response_type, partial_response in partial_responses.items():
+                        render_analysis(response_type, partial_response)
+
+        def show_partial_email(partial):
+            if isinstance(partial, dict) and isinstance(partial.get('body'), str):
+                with email_placeholder.container():
+                    render_follow_up_email(partial)
+
+        # Keyed by content, so a transcript whose sentences changed is analyzed again
+        content_hash = hash_transcript(transcript_content)
+        if content_hash not in st.session_state.analyses:
+            with st.spinner('Analyzing transcript and generating follow-up email...'):
+                analyses, follow_up_email = get_analyses(
+                    transcript_content,
+                    show_partial_analysis,
+                    show_partial_email
+                )
+            if analyses and follow_up_email:
+                st.session_state.analyses[content_hash] = (analyses, follow_up_email)
+        else:
+            analyses, follow_up_email = st.session_state.analyses[content_hash]
+        gpt4o_responses = {t: analyses[t] for t in prompt_types} if analyses else None
+        if gpt4o_responses and follow_up_email:
+            with analysis_placeholder.container():
+                for response_type, gpt4o_response in gpt4o_responses.items():
+                    render_analysis(response_type, gpt4o_response)
+            with email_placeholder.container():
+                render_follow_up_email(follow_up_email)
 
             if auto_email and email:
                 with st.spinner('Sending email...'):
-                    html_content = format_analysis_to_html(prompt_type, gpt4o_response, follow_up_email['body'])
-
-                    # Create a set of unique speakers
-                    speakers = set(sentence['speaker_name'] for sentence in selected_transcript['sentences'])
+                    # All selected analyses go out together in a single email
+                    html_content = format_analysis_to_html(prompt_type, gpt4o_responses, follow_up_email['body'])
 
                     # Format the date
                     date = datetime.datetime.fromtimestamp(selected_transcript['date'] / 1000).strftime('%Y-%m-%d')
 
                     # Create the email subject
-                    subject = f"Meeting Analysis: {prompt_type.replace('_', ' ').title()} - {selected_transcript['title']} - {date} - Speakers: {', '.join(speakers)}"
+                    subject = f"Meeting Analysis: {ANALYSIS_LABELS[prompt_type]} - {selected_transcript['title']} - {date} - Speakers: {', '.join(speakers)}"
 
                     send_email(email, subject, html_content)
         else:
+            analysis_placeholder.empty()
+            email_placeholder.empty()
             st.error("Failed to generate analysis or follow-up email. Please check the error messages above and try again.")
 
-# Trigger analysis based on button clicks
-if analyze_buttons['financial']:
-    handle_analysis('financial')
-if analyze_buttons['action_items']:
-    handle_analysis('action_items')
-if analyze_buttons['risk_assessment']:
-    handle_analysis('risk_assessment')
-if analyze_buttons['tax_info']:
-    handle_analysis('tax_info')
-if analyze_buttons['client_concerns']:
-    handle_analysis('client_concerns')
-if analyze_buttons['compliance']:
-    handle_analysis('compliance')
+# Trigger analysis on submit
+if analyze_button:
+    handle_analysis(analysis_type)
 
 # Add a footer
 st.markdown("---")